@@ -5,14 +5,18 @@ import joblib
 import asyncio
 import uuid
 import datetime
+import time
+import json
+from collections import deque
 import requests
 from contextlib import asynccontextmanager
 from supabase import create_client
 from sklearn.neighbors import BallTree
 from sklearn.ensemble import RandomForestRegressor
 from geopy.distance import geodesic
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import tracery
@@ -29,6 +33,14 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 # Shared memory
 JOB_QUEUE = asyncio.Queue()
 JOB_STATUS = {}
+JOB_TIMES = {}             # job_id -> queued_at / started_at / finished_at
+JOB_SEQ = {}               # job_id -> enqueue sequence number, while still waiting
+ENQUEUED = 0               # jobs ever put on JOB_QUEUE
+DEQUEUED = 0               # jobs ever taken off JOB_QUEUE
+STATUS_SUBSCRIBERS = {}    # job_id -> set of per-connection inboxes
+FINISHED_JOBS = deque()    # (finished_at, job_id), oldest first, for ageing out
+JOB_RETENTION_SECONDS = 3600
+TERMINAL_STATUSES = {"completed", "failed", "unknown"}
 
 # Global AI "Brains"
 AMENITY_BRAIN = None
@@ -150,28 +162,68 @@ async def traffic_spy_worker():
             print(f"⚠️ [Traffic Spy] Error: {e}")
         await asyncio.sleep(1800)
 
+# --- JOB STATUS ---
+def job_snapshot(job_id):
+    status = JOB_STATUS.get(job_id, "unknown")
+    snap = {"job_id": job_id, "status": status, **JOB_TIMES.get(job_id, {})}
+    if status == "queuing": snap["position"] = JOB_SEQ[job_id] - DEQUEUED
+    return snap
+
+def publish_status(job_id):
+    inboxes = STATUS_SUBSCRIBERS.get(job_id)
+    if not inboxes: return
+    snap = job_snapshot(job_id)
+    for inbox in inboxes: inbox.put_nowait(snap)
+
+def set_job_status(job_id, status):
+    JOB_STATUS[job_id] = status
+    stamp = {"queuing": "queued_at", "processing": "started_at"}.get(status, "finished_at")
+    now = time.time()
+    JOB_TIMES.setdefault(job_id, {})[stamp] = now
+    publish_status(job_id)
+    if status in TERMINAL_STATUSES:
+        FINISHED_JOBS.append((now, job_id))
+        # Finished jobs are forgotten after an hour and then read back as "unknown"
+        while FINISHED_JOBS and FINISHED_JOBS[0][0] < now - JOB_RETENTION_SECONDS:
+            _, old_id = FINISHED_JOBS.popleft()
+            JOB_STATUS.pop(old_id, None)
+            JOB_TIMES.pop(old_id, None)
+
+def merge_user_properties(brain, user_id):
+    # Blocking Supabase fetch + merge; runs off the event loop
+    resp = supabase.table('properties').select("*").eq('user_id', user_id).execute()
+    user_props = pd.DataFrame(resp.data)
+    if user_props.empty: return None
+    new_brain = brain.copy()
+    if not new_brain.empty and 'user_id' in new_brain.columns:
+        new_brain = new_brain[new_brain['user_id'] != user_id]
+    return pd.concat([new_brain, user_props], ignore_index=True)
+
 async def queue_worker():
+    global DEQUEUED, PROPERTY_BRAIN
     print("👷 [Worker] Online.")
     while True:
         job = await JOB_QUEUE.get()
         job_id, user_id = job['job_id'], job['user_id']
         try:
-            JOB_STATUS[job_id] = "processing"
-            resp = supabase.table('properties').select("*").eq('user_id', user_id).execute()
-            user_props = pd.DataFrame(resp.data)
-            global PROPERTY_BRAIN
-            if not user_props.empty:
-                new_brain = PROPERTY_BRAIN.copy()
-                if not new_brain.empty and 'user_id' in new_brain.columns:
-                    new_brain = new_brain[new_brain['user_id'] != user_id]
-                new_brain = pd.concat([new_brain, user_props], ignore_index=True)
+            DEQUEUED += 1
+            JOB_SEQ.pop(job_id, None)
+            set_job_status(job_id, "processing")
+            # Everyone still waiting just moved up one place; only watched jobs need telling
+            for waiting_id in [j for j in STATUS_SUBSCRIBERS if JOB_STATUS.get(j) == "queuing"]:
+                publish_status(waiting_id)
+            await asyncio.sleep(0)
+            # Threads keep the loop free so status events reach subscribers as they happen
+            new_brain = await asyncio.to_thread(merge_user_properties, PROPERTY_BRAIN, user_id)
+            if new_brain is not None:
                 PROPERTY_BRAIN = new_brain
-                save_backup_to_cloud('properties.pkl', PROPERTY_BRAIN)
-            JOB_STATUS[job_id] = "completed"
+                await asyncio.to_thread(save_backup_to_cloud, 'properties.pkl', new_brain)
+            set_job_status(job_id, "completed")
         except:
-            JOB_STATUS[job_id] = "failed"
+            set_job_status(job_id, "failed")
         finally:
             JOB_QUEUE.task_done()
+        await asyncio.sleep(0)
 
 # --- LIFESPAN ---
 @asynccontextmanager
@@ -210,13 +262,50 @@ class QueueRequest(BaseModel):
 
 @app.post("/queue-update")
 async def queue_update(req: QueueRequest):
+    global ENQUEUED
     job_id = str(uuid.uuid4())
+    ENQUEUED += 1
+    JOB_SEQ[job_id] = ENQUEUED
+    set_job_status(job_id, "queuing")
+    position = JOB_SEQ[job_id] - DEQUEUED
     await JOB_QUEUE.put({"job_id": job_id, "user_id": req.user_id})
-    return {"job_id": job_id, "position": JOB_QUEUE.qsize()}
+    return {"job_id": job_id, "position": position}
 
 @app.get("/queue-status/{job_id}")
 def check_status(job_id: str):
-    return {"status": JOB_STATUS.get(job_id, "queuing")}
+    # "unknown" means the id was never queued here, so clients should stop polling
+    return job_snapshot(job_id)
+
+# Push-based alternative to polling: /queue-events?job_ids=a,b,c
+# Streams one "status" event per transition until every job is finished or unknown.
+@app.get("/queue-events")
+async def queue_events(job_ids: str):
+    ids = list(dict.fromkeys(j for j in job_ids.split(',') if j))
+
+    async def stream():
+        # Idle subscribers only cost a queue and a parked coroutine
+        inbox = asyncio.Queue()
+        for j in ids: STATUS_SUBSCRIBERS.setdefault(j, set()).add(inbox)
+        try:
+            open_ids = set(ids)
+            for j in ids: inbox.put_nowait(job_snapshot(j))
+            while open_ids:
+                try:
+                    snap = await asyncio.wait_for(inbox.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if snap['job_id'] not in open_ids: continue
+                yield f"event: status\ndata: {json.dumps(snap)}\n\n"
+                if snap['status'] in TERMINAL_STATUSES: open_ids.discard(snap['job_id'])
+        finally:
+            for j in ids:
+                subs = STATUS_SUBSCRIBERS.get(j)
+                if subs is None: continue
+                subs.discard(inbox)
+                if not subs: del STATUS_SUBSCRIBERS[j]
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # NEW: Manual refresh endpoint if Supabase data changes
 @app.post("/refresh-properties")
@@ -242,17 +331,19 @@ class TrafficRequest(BaseModel):
     end_lng: float
     time_context: float = -1.0 
 
+def predict_congestion(day=-1, hour=-1.0, retrain=True):
+    global TRAFFIC_MODEL
+    if TRAFFIC_MODEL is None and retrain: train_traffic_model()
+    if not TRAFFIC_MODEL: return 1.0
+    target_day = datetime.datetime.now().weekday() if day == -1 else day
+    target_hour = datetime.datetime.now().hour if hour == -1 else hour
+    return TRAFFIC_MODEL.predict(pd.DataFrame([[target_day, target_hour]], columns=['day_of_week', 'hour_of_day']))[0]
+
 @app.post("/predict-traffic")
 def predict_traffic(req: TrafficRequest):
     dist_km = geodesic((req.start_lat, req.start_lng), (req.end_lat, req.end_lng)).km
     base_minutes = (dist_km / 30) * 60 
-    congestion = 1.0
-    global TRAFFIC_MODEL
-    if TRAFFIC_MODEL is None: train_traffic_model()
-    if TRAFFIC_MODEL:
-        target_day = datetime.datetime.now().weekday()
-        target_hour = datetime.datetime.now().hour if req.time_context == -1 else req.time_context
-        congestion = TRAFFIC_MODEL.predict(pd.DataFrame([[target_day, target_hour]], columns=['day_of_week', 'hour_of_day']))[0]
+    congestion = predict_congestion(hour=req.time_context)
     
     predicted_minutes = base_minutes * congestion
     color = "#10b981"
@@ -262,6 +353,14 @@ def predict_traffic(req: TrafficRequest):
 
 # --- INTELLIGENT MATCHING LOGIC ---
 
+class CommuteAnchor(BaseModel):
+    lat: float
+    lng: float
+    max_minutes: float = Field(gt=0)
+    day_of_week: int = Field(-1, ge=-1, le=6)         # -1 = today
+    hour_of_day: float = Field(-1.0, ge=-1, lt=24)    # -1 = now
+    priority: float = Field(0.0, ge=0)                # > 0 also rewards shorter commutes in the match score
+
 class UserPreference(BaseModel):
     filter_map_id: str | None = None  # <--- UPDATED: To handle filtering by Map ID
     personas: list[str]
@@ -269,50 +368,141 @@ class UserPreference(BaseModel):
     health_priority: float
     education_priority: float
     lifestyle_priority: float
+    commute_anchors: list[CommuteAnchor] = []
 
-@app.post("/recommend")
-def recommend(pref: UserPreference):
-    if PROPERTY_BRAIN.empty: return {"matches": []}
-    
-    # --- FILTER BRAIN BY MAP ID ---
+class BatchPreference(BaseModel):
+    filter_map_id: str | None = None  # Applies to every profile; a profile's own map id must match
+    profiles: list[UserPreference] = Field(max_length=500)
+
+CATEGORY_KEYS = list(CATEGORIES.keys())
+
+def filter_brain(map_id):
     active_brain = PROPERTY_BRAIN
-    if pref.filter_map_id:
+    if map_id:
         if 'map_id' in active_brain.columns:
-            active_brain = active_brain[active_brain['map_id'] == pref.filter_map_id]
+            active_brain = active_brain[active_brain['map_id'] == map_id]
         else:
             # Fallback for old data without map_id
             print("⚠️ Warning: 'map_id' column not found in Property Brain")
-    
-    if active_brain.empty: return {"matches": []}
-
-    results = []
-    
-    # Use 'active_brain' (filtered) instead of global PROPERTY_BRAIN
-    for _, row in active_brain.iterrows():
-        scores, metadata = score_property(row['lat'], row['lng'], pref.personas)
-        
-        total = (
-            (pref.safety_priority * scores.get('safety', 0)) +
-            (pref.health_priority * scores.get('health', 0)) +
-            (pref.education_priority * scores.get('education', 0)) +
-            (pref.lifestyle_priority * scores.get('lifestyle', 0))
-        )
-        
+    return active_brain
+
+def commute_minutes(brain, anchor, congestion):
+    # Spherical haversine for every property at once, with the same 30km/h base speed as
+    # /predict-traffic. That endpoint uses ellipsoidal geodesic distance, so near max_minutes
+    # the two can disagree by a fraction of a percent.
+    lat = np.radians(brain['lat'].to_numpy(dtype=float))
+    lng = np.radians(brain['lng'].to_numpy(dtype=float))
+    a_lat, a_lng = np.radians(anchor.lat), np.radians(anchor.lng)
+    h = np.sin((lat - a_lat) / 2) ** 2 + np.cos(lat) * np.cos(a_lat) * np.sin((lng - a_lng) / 2) ** 2
+    dist_km = 2 * 6371.0 * np.arcsin(np.sqrt(h))
+    return (dist_km / 30) * 60 * congestion
+
+def commute_filter(brain, profiles):
+    # (profiles x properties) reachability mask and commute bonus, plus minutes per anchor
+    allowed = np.ones((len(profiles), len(brain)), dtype=bool)
+    bonus = np.zeros((len(profiles), len(brain)))
+    minutes = [[] for _ in profiles]
+    congestion = {}
+    cache = {}
+    for n, pref in enumerate(profiles):
+        for anchor in pref.commute_anchors:
+            slot = (anchor.day_of_week, anchor.hour_of_day)
+            # One model lookup per time slot; never retrain from inside a recommend call
+            if slot not in congestion: congestion[slot] = predict_congestion(*slot, retrain=False)
+            key = (anchor.lat, anchor.lng, *slot)
+            if key not in cache: cache[key] = commute_minutes(brain, anchor, congestion[slot])
+            m = cache[key]
+            allowed[n] &= m <= anchor.max_minutes
+            if anchor.priority:
+                bonus[n] += anchor.priority * np.clip(1 - m / anchor.max_minutes, 0, 1)
+            minutes[n].append(m)
+    return allowed, bonus, minutes
+
+def build_feature_matrix(brain, personas):
+    # One row per property: [safety, health, education, lifestyle] spatial scores
+    features = np.zeros((len(brain), len(CATEGORY_KEYS)))
+    all_metadata = []
+    for i, (lat, lng) in enumerate(zip(brain['lat'], brain['lng'])):
+        scores, metadata = score_property(lat, lng, personas)
+        features[i] = [scores.get(cat, 0) for cat in CATEGORY_KEYS]
+        all_metadata.append(metadata)
+    return features, all_metadata
+
+def rank_profiles(brain, profiles, filter_map_id):
+    # Drop properties no profile can reach in time before any spatial scoring happens
+    allowed, bonus, minutes = commute_filter(brain, profiles)
+    keep = allowed.any(axis=0)
+    brain = brain[keep]
+    allowed, bonus = allowed[:, keep], bonus[:, keep]
+    minutes = [[m[keep] for m in anchor_minutes] for anchor_minutes in minutes]
+
+    # Spatial scoring only depends on the boosting personas (duplicates boost again),
+    # so profiles sharing that set reuse one pass
+    persona_sets = {}
+    group_of = []
+    for pref in profiles:
+        key = tuple(sorted(p for p in pref.personas if p in PERSONA_BOOSTS))
+        if key not in persona_sets:
+            persona_sets[key] = (len(persona_sets), *build_feature_matrix(brain, list(key)))
+        group_of.append(persona_sets[key][0])
+
+    features = np.stack([f for _, f, _ in persona_sets.values()])  # (sets x properties x categories)
+    metadata = [m for _, _, m in persona_sets.values()]
+    weights = np.array([
+        [p.safety_priority, p.health_priority, p.education_priority, p.lifestyle_priority]
+        for p in profiles
+    ])                                                             # (profiles x categories)
+
+    # Score every profile against every property in one pass -> (profiles x properties)
+    totals = np.einsum('nc,npc->np', weights, features[group_of]) + bonus
+
+    ids = brain['id'].astype(str).tolist()
+    names = brain['name'].tolist()
+    all_results = []
+    for n, pref in enumerate(profiles):
         # FIX: Allow matches with score 0 if we are filtering by a specific map
         # This ensures isolated maps (Map 1) still return results for description generation
-        if total > 0.1 or pref.filter_map_id:
-            headline, body = generate_copy(pref.personas, metadata)
+        candidates = np.flatnonzero(allowed[n] if filter_map_id else allowed[n] & (totals[n] > 0.1))
+        order = candidates[np.argsort(-totals[n][candidates], kind='stable')][:10]
+
+        results = []
+        for p in order:
+            meta = metadata[group_of[n]][p]
+            headline, body = generate_copy(pref.personas, meta)
             results.append({
-                "id": str(row['id']),
-                "name": row['name'],
-                "match_score": total,
+                "id": ids[p],
+                "name": names[p],
+                "match_score": float(totals[n][p]),
                 "headline": headline,
                 "body": body,
-                "highlights": [f"{v['type']} ({v['dist']}km)" for k,v in metadata.items()][:3]
+                "highlights": [f"{v['type']} ({v['dist']}km)" for k,v in meta.items()][:3],
+                "commute_minutes": [round(m[p]) for m in minutes[n]]
             })
-            
-    results.sort(key=lambda x: x['match_score'], reverse=True)
-    return {"matches": results[:10], "matched_ids": [r['id'] for r in results[:10]]}
+        all_results.append({"matches": results, "matched_ids": [r['id'] for r in results]})
+    return all_results
+
+@app.post("/recommend")
+def recommend(pref: UserPreference):
+    if PROPERTY_BRAIN.empty: return {"matches": []}
+    
+    # --- FILTER BRAIN BY MAP ID ---
+    active_brain = filter_brain(pref.filter_map_id)
+    if active_brain.empty: return {"matches": []}
+
+    return rank_profiles(active_brain, [pref], pref.filter_map_id)[0]
+
+@app.post("/recommend-batch")
+def recommend_batch(batch: BatchPreference):
+    for i, pref in enumerate(batch.profiles):
+        if pref.filter_map_id and pref.filter_map_id != batch.filter_map_id:
+            raise HTTPException(status_code=422, detail=f"profiles[{i}].filter_map_id does not match the batch filter_map_id")
+    empty = [{"matches": [], "matched_ids": []} for _ in batch.profiles]
+    if PROPERTY_BRAIN.empty or not batch.profiles: return {"results": empty}
+
+    active_brain = filter_brain(batch.filter_map_id)
+    if active_brain.empty: return {"results": empty}
+
+    return {"results": rank_profiles(active_brain, batch.profiles, batch.filter_map_id)}
 
 def score_property(prop_lat, prop_lng, personas=[]):
     if not AMENITY_BRAIN: return {}, {}
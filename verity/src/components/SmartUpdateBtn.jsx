@@ -45,31 +45,39 @@ export const SmartUpdateBtn = () => {
     const pollStatus = (jobId) => {
         if (!jobId || jobId === "undefined") return;
 
-        const interval = setInterval(async () => {
-            try {
-                const res = await fetch(`${BASE_URL}/queue-status/${jobId}`);
-                if (!res.ok) return;
-
-                const data = await res.json();
-
-                if (data.status === 'processing') setStatus('processing');
-                
-                if (data.status === 'completed') {
-                    clearInterval(interval);
-                    setStatus('success');
-                    setTimeout(() => setStatus('idle'), 4000);
-                }
-                
-                if (data.status === 'failed') {
-                    clearInterval(interval);
-                    setStatus('error');
-                    setTimeout(() => setStatus('idle'), 3000);
-                }
-            } catch (err) { 
-                console.error("Polling error:", err);
-                clearInterval(interval); 
+        // Server pushes each status transition, so no polling loop is needed
+        const events = new EventSource(`${BASE_URL}/queue-events?job_ids=${jobId}`);
+
+        events.addEventListener('status', (e) => {
+            const data = JSON.parse(e.data);
+
+            if (data.status === 'queuing') setMeta((m) => ({ ...m, position: data.position }));
+
+            if (data.status === 'processing') setStatus('processing');
+            
+            if (data.status === 'completed') {
+                events.close();
+                setStatus('success');
+                setTimeout(() => setStatus('idle'), 4000);
+            }
+            
+            if (data.status === 'failed' || data.status === 'unknown') {
+                events.close();
+                setStatus('error');
+                setTimeout(() => setStatus('idle'), 3000);
+            }
+        });
+
+        // EventSource reconnects on its own and the server resends every job's snapshot,
+        // so only give up once the browser has stopped retrying
+        events.onerror = (err) => {
+            console.error("Status stream error:", err);
+            if (events.readyState === EventSource.CLOSED) {
+                events.close();
+                setStatus('error');
+                setTimeout(() => setStatus('idle'), 3000);
             }
-        }, 2000);
+        };
     };
 
     return (